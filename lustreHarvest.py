@@ -18,12 +18,18 @@
 # or MDTs eg.
 #   /proc/fs/lustre/{mds,mdt}/data-MDT0000/exports/10.1.14.1@o2ib/stats
 
-import os, socket, select, sys, cPickle, time, subprocess, hashlib
+import os, socket, select, sys, cPickle, time, subprocess, hashlib, mmap, zlib, math, heapq, errno
 
 port = 8022  # default port
-clientSend = 3  # number of gathers per minute on clients
+dests = []   # extra ( (serverName, port), fsList ) for clients to send to
+dt = 20.0    # seconds between gathers on clients. clients and server must agree
 serverInterfaceName = None
 
+# clients in hot mode also gather the hotClients busiest clients (by bytes
+# and by ops) every hotInterval seconds. dt must be a multiple of hotInterval
+hotClients = 0
+hotInterval = 2.0
+
 # map between fs name in lustre and the name we want to see in ganglia
 nameMap = { 'data':'vu_short',
             'apps':'vu_apps',
@@ -48,6 +54,87 @@ statsDir = { 'oss':['/proc/fs/lustre/obdfilter'], 'mds':['/proc/fs/lustre/mds',
 verbose = 0
 dryrun = 0
 
+# clients with presum set add up the stats from all their local osts (or mdts)
+# for each client before sending. ostDetail also sends per-ost totals
+presum = 0
+ostDetail = 0
+
+# clients with jobStats set also send the per-job counters from each ost/mdt's
+# job_stats file. the server spoofs the busiest jobTop jobs of each fs into
+# ganglia as metrics of the server machine, and if jobFile is set appends the
+# rates of all active jobs to that file every sweep
+jobStats = 0
+jobTop = 10
+jobFile = None
+
+# the server can also add up client rates for each batch job, using a file
+# kept up to date by the batch system with lines of 'hostname jobid [jobid ...]'.
+# the file is re-read when it changes. the busiest jobTop jobs are sent to
+# ganglia as eg. <fs>_jobnodes_<jobid>_read_bytes
+jobMapFile = None
+jobMap = { 'mtime':None, 'node':{}, 'job':{} }
+
+# clients with opDetail set also send a vector of counts of the metadata ops
+# in mdsOpNames for each client of each mdt. the server sends the mdsOpTop
+# busiest of these ops for each client to ganglia as eg. <fs>_mds_open_ops.
+# the order of mdsOpNames must be the same on clients and server
+opDetail = 0
+mdsOpNames = ( 'open', 'close', 'mknod', 'link', 'unlink', 'mkdir', 'rmdir', 'rename',
+               'getattr', 'setattr', 'getxattr', 'setxattr', 'statfs', 'sync' )
+mdsOpTop = 3
+
+# the server finds the loadTop busiest osts/mdts of each fs
+loadTop = 5
+
+# fields in the data for each ost/mdt that aren't clients
+targetMeta = ( 'type', 'count', 'time' )
+
+# clients with stagger set read their osts/mdts one at a time, spread over
+# the first staggerBudget of each interval, and send at the next boundary.
+# each ost/mdt carries the time it was read
+stagger = 0
+staggerBudget = 0.5
+
+# clients in delta mode send a full keyframe on connect and then every
+# keyframeEvery sweeps. in between only changed counters are sent
+deltaMode = 0
+keyframeEvery = 30
+
+# clients in udp mode send each sweep as a set of datagrams of at most
+# udpEntries clients each, one or more per ost/mdt. servers in udp mode also
+# listen for these on the udp port of the same number. datagrams are never
+# re-sent so lost ones just mean part of a sweep is missing
+udp = 0
+udpEntries = 200
+udpRcvBuf = 4*1024*1024
+
+# the server keeps its state in snapshotFile.<port> so that it can resume
+# rates straight away after a restart, if the snapshot is recent enough.
+# None to disable
+snapshotFile = '/var/tmp/lustreHarvest.snapshot'
+snapshotMaxAge = 120
+snapshotKeys = ( 'd', 'j', 'load', 'busiest', 'base', 'tOld', 'hitters', 'ops' )
+
+# the server keeps a fixed size summary of the clients that did the most of
+# each metric in each fs over the last hour, day and week. only the biggest
+# hitterSize clients of each are kept. --dumphitters prints the top hitterTop
+# from the snapshot
+hitterSize = 100
+hitterTop = 20
+hitterMetrics = ( 'read_bytes', 'write_bytes', 'oss_ops', 'mds_ops' )
+hitterWindows = ( ( 'hour', 3600 ), ( 'day', 86400 ), ( 'week', 7*86400 ) )
+dumpHitters = 0
+
+# the server appends the data of every sweep it processes to recordFile, and
+# the offset of each sweep to recordFile.idx. --replay runs a recording back
+# through the sweep processing, at the recorded pace or as fast as possible,
+# and sends the metrics to replaySink (host:port of a gmond udp channel or a
+# file, '-' for stdout) instead of gmond
+recordFile = None
+replayFile = None
+replayFast = 0
+replaySink = '-'
+
 # shared secret between client and servers. only readable by root
 secretFile = '/root/.lustreHarvest.secret'
 
@@ -55,8 +142,8 @@ gmondHost = '192.168.55.13' # g2 IPoIB # '239.2.11.71'   # multicast address or
 gmondPort = 8650   # 8649
 gmondProtocol = 'udp' # 'multicast'  # 'multicast' or 'udp'
 
-dt = 60.0/clientSend
 hostCache = {}
+nidHosts = {}
 secretText = None
 
 def getHost(ip):
@@ -70,21 +157,30 @@ def getHost(ip):
    hostCache[ip] = host
    return host
 
+def gangliaTmax():
+   # allow ganglia to miss a couple of sweeps before it thinks a metric is stale
+   return max(1, int(round(3*dt)))
+
 def spoofIntoGanglia(g, o, name, unit):
    if len(o) == 0 or dryrun:
       return
+   tmax = gangliaTmax()
    for i, d in o.iteritems():
       # decode ip@lnet to a hostname
       ip = i.split('@')[0]
-      host = getHost(ip)
+      if replayFile != None:
+         # replays are often run offline, and lookups would skew the timing
+         host = ip
+      else:
+         host = getHost(ip)
       #print 'ip', ip, 'host', host
       if host == None:
          # if the host is unknown then it could be data for a different cluster. ignore it.
          #print >>sys.stderr, 'unknown host', i, ip
          continue
       spoofStr = ip + ':' + host
-      #print 'g.send(', name, '%.2f', d, 'float', unit, 'both', 60, 0, '', spoofStr, ')'
-      g.send( name, '%.2f' % d, 'float', unit, 'both', 60, 0, "", spoofStr )
+      #print 'g.send(', name, '%.2f', d, 'float', unit, 'both', tmax, 0, '', spoofStr, ')'
+      g.send( name, '%.2f' % d, 'float', unit, 'both', tmax, 0, "", spoofStr )
 
 def readSecret():
    global secretText
@@ -105,7 +201,7 @@ def readSecret():
       sys.exit(1)
    secretText = str(l)
 
-def computeRates( sOld, s, tOld, t ):
+def computeRates( sOld, s, tOld, t, quiet = 0 ):
    err = 0
    if len(s) == 0:  # no data for this fs
       return {}, err
@@ -121,7 +217,8 @@ def computeRates( sOld, s, tOld, t ):
       for h in s.keys():
          ds = s[h] - sOld[h]
          if ds < 0:
-            print >>sys.stderr, 'negative rate', h, ds, s[h], sOld[h]
+            if not quiet:
+               print >>sys.stderr, 'negative rate', h, ds, s[h], sOld[h]
             err = 1
             ds = 0
          rates[h] = float(ds)/deltat
@@ -132,7 +229,8 @@ def computeRates( sOld, s, tOld, t ):
       if h in sOld.keys():
          ds = s[h] - sOld[h]
          if ds < 0:
-            print >>sys.stderr, 'clients changed. negative rate', h, ds, s[h], sOld[h]
+            if not quiet:
+               print >>sys.stderr, 'clients changed. negative rate', h, ds, s[h], sOld[h]
             err = 1
             ds = 0
          rates[h] = float(ds)/deltat
@@ -140,7 +238,7 @@ def computeRates( sOld, s, tOld, t ):
          rates[h] = 0.0
    return rates, err
 
-def readStatsFile(fn):
+def readStatsFile(fn, opVector = 0):
    # turn into a dict
    f = open(fn, 'r')
    i = {}
@@ -156,17 +254,57 @@ def readStatsFile(fn):
          if ops == None:
             ops = 0
          ops += int(j[0])
-   # do read and write
-   r = None
+   # do read and write. the number of samples is the number of rpcs
+   r, rc = None, 0
    if 'read_bytes' in i.keys():  # only populated in stats file if used
       r = int(i['read_bytes'][5])
-   w = None
+      rc = int(i['read_bytes'][0])
+   w, wc = None, 0
    if 'write_bytes' in i.keys():
       w = int(i['write_bytes'][5])
-   return ( r, w, ops )
-
-def gatherStats(fs):
-   s = {}
+      wc = int(i['write_bytes'][0])
+   # optionally the count of each metadata op, in the order of mdsOpNames
+   opv = None
+   if opVector:
+      opv = tuple([ int(i.get(n, ( 0, ))[0]) for n in mdsOpNames ])
+   return ( r, w, ops, rc, wc, opv )
+
+def readJobStatsFile(fn):
+   # streaming parse of the yaml-like job_stats file eg.
+   # job_stats:
+   # - job_id:          1234.pbs
+   #   snapshot_time:   1352102155
+   #   read_bytes:      { samples:           0, unit: bytes, min:       0, max:       0, sum:               0 }
+   #   write_bytes:     { samples:           1, unit: bytes, min:    4096, max:    4096, sum:            4096 }
+   #   getattr:         { samples:           0, unit:  reqs }
+   #   ...
+   # these can be very large on busy osts so only do the minimum of work on each line.
+   # like readStatsFile, all ops except ping are summed and called iops
+   jobs = {}
+   job = None
+   for ll in open(fn, 'r'):
+      if ll[0] == '-':  # start of a new job
+         if job != None:
+            jobs[job] = ( r, w, ops )
+         job = ll.split(':', 1)[1].strip()
+         r, w, ops = 0, 0, 0
+         continue
+      b = ll.find('{')
+      if b == -1 or job == None:  # snapshot_time etc.
+         continue
+      n = ll[:b].strip()[:-1]
+      j = ll[b+1:].split(',')
+      if n == 'read_bytes':
+         r = int(j[4].split()[1])
+      elif n == 'write_bytes':
+         w = int(j[4].split()[1])
+      elif n not in ( 'read', 'write', 'ping' ):
+         ops += int(j[0].split()[1])
+   if job != None:
+      jobs[job] = ( r, w, ops )
+   return jobs
+
+def findTargets(fs):
    osts = []
    # handle both mds and oss
    for machType, lld in statsDir.iteritems():
@@ -179,43 +317,206 @@ def gatherStats(fs):
          for d in dirs:
             if d[:len(fs)] == fs and len(d) > len(fs) and d[len(fs)] == '-':
                osts.append((machType, ld, d))
+   return osts
 
-   for machType, ld, o in osts:
-      s[o] = {}
-      s[o]['type'] = machType   # oss or mds data
-      ostDir = ld + '/' + o + '/exports'
-      # loop over all clients
-      for c in os.listdir(ostDir):
-         #print c
-         r, w, ops = None, None, None
-         try:
-            r, w, ops = readStatsFile(ostDir + '/' + c + '/stats')
-         except:
-            pass
+def gatherStats(fs, only = None):
+   # only is an optional list of the clients to read stats for
+   s = {}
+   for machType, ld, o in findTargets(fs):
+      readTarget(s, machType, ld, o, only)
+   #print s
+   return s
 
-         # don't report null osts
-         if (r, w, ops) == (None, None, None):
-            continue
+def gatherStaggered(fsList, tStart, window):
+   # read each ost/mdt of all the fs's at its own offset in the window that
+   # starts at tStart, rather than all of them at once
+   targets = []
+   d = {}
+   for f in fsList:
+      d[f] = {}
+      for t in findTargets(f):
+         targets.append((f,) + t)
+   n = len(targets)
+   for k in range(n):
+      f, machType, ld, o = targets[k]
+      sl = tStart + window*k/n - time.time()
+      if sl > 0:
+         time.sleep(sl)
+      readTarget(d[f], machType, ld, o)
+      t = time.time()
+      d[f][o]['time'] = t
+      if o + '/jobs' in d[f].keys():
+         d[f][o + '/jobs']['time'] = t
+   return d
+
+def readTarget(s, machType, ld, o, only = None):
+   # add the stats of one ost/mdt, and maybe its jobs, to s
+   s[o] = {}
+   s[o]['type'] = machType   # oss or mds data
+   ostDir = ld + '/' + o + '/exports'
+   clients = only
+   if clients == None:
+      clients = os.listdir(ostDir)
+   # loop over all clients
+   for c in clients:
+      #print c
+      r, w, ops, rc, wc, opv = None, None, None, 0, 0, None
+      try:
+         r, w, ops, rc, wc, opv = readStatsFile(ostDir + '/' + c + '/stats', opDetail and machType == 'mds')
+      except:
+         pass
 
-         # we don't want to report oss<->oss or mds<->oss or mds<->mds traffic
-         #   mds->oss has snapshot_time only,
-         #      which is covered by the above None,None,None case.
-         #   oss->{oss,mds} has no read_bytes or write_bytes in it.
-         #      it may have eg. create/destry/setattr iops but we don't care.
-         if machType == 'oss' and r == None and w == None:
-            continue
+      # don't report null osts
+      if (r, w, ops) == (None, None, None):
+         continue
 
-         if r == None:
-            r = 0
-         if w == None:
-            w = 0
-         if ops == None:
-            ops = 0
+      # we don't want to report oss<->oss or mds<->oss or mds<->mds traffic
+      #   mds->oss has snapshot_time only,
+      #      which is covered by the above None,None,None case.
+      #   oss->{oss,mds} has no read_bytes or write_bytes in it.
+      #      it may have eg. create/destry/setattr iops but we don't care.
+      if machType == 'oss' and r == None and w == None:
+         continue
 
-         s[o][c] = (r, w, ops)
-         #print s[o][c]
-   #print s
-   return s
+      if r == None:
+         r = 0
+      if w == None:
+         w = 0
+      if ops == None:
+         ops = 0
+
+      s[o][c] = (r, w, ops, rc, wc)
+      if opv != None:
+         s[o][c] += ( opv, )
+      #print s[o][c]
+
+   # per-job counters go in a separate entry for this ost/mdt
+   if jobStats and only == None:
+      try:
+         j = readJobStatsFile(ld + '/' + o + '/job_stats')
+      except:
+         j = {}
+      if len(j):
+         j['type'] = machType + 'job'   # ossjob or mdsjob
+         s[o + '/jobs'] = j
+
+def addCounts(a, b):
+   # add up two client entries, including any vectors of per-op counts
+   c = []
+   for x, y in zip(a, b):
+      if type(x) == tuple:
+         c.append(tuple([ i + j for i, j in zip(x, y) ]))
+      else:
+         c.append(x + y)
+   return tuple(c)
+
+def presumStats(s):
+   # add up all the osts (or mdts) of a fs on this server for each client so
+   # that the server has less to receive and sum. oss and mds data stay separate
+   p = {}
+   times = {}
+   for ost, d in s.iteritems():
+      machType = d['type']
+      if machType not in p.keys():
+         p[machType] = { 'type':machType, 'count':0 }
+      ps = p[machType]
+      ps['count'] += 1
+      rt, wt, opst = 0, 0, 0
+      for i, v in d.iteritems():
+         if i in targetMeta:
+            continue
+         if i in ps:
+            ps[i] = addCounts(ps[i], v)
+         else:
+            ps[i] = v
+         rt += v[0]
+         wt += v[1]
+         opst += v[2]
+      # optional per-ost totals across all clients
+      if ostDetail and machType in ( 'oss', 'mds' ):
+         if 'detail' not in p.keys():
+            p['detail'] = { 'type':'detail' }
+         p['detail'][ost] = ( rt, wt, opst )
+      # staggered reads. sums are treated as read at the mean time of their osts
+      if 'time' in d.keys():
+         for k in ( machType, 'detail' ):
+            if k in p.keys():
+               times.setdefault(k, []).append(d['time'])
+   for k, l in times.iteritems():
+      p[k]['time'] = sum(l)/len(l)
+   return p
+
+def findHotClients(old, new, k):
+   # the k clients that did the most bytes and the k that did the most ops
+   # between two full gathers
+   b = {}
+   ops = {}
+   for f in new.keys():
+      oldf = old.get(f, {})
+      for ost, d in new[f].iteritems():
+         if d['type'] not in ( 'oss', 'mds' ) or ost not in oldf.keys():
+            continue
+         prev = oldf[ost]
+         for i, v in d.iteritems():
+            if i in targetMeta or i not in prev:
+               continue
+            p = prev[i]
+            b[i] = b.get(i, 0) + (v[0] - p[0]) + (v[1] - p[1])
+            ops[i] = ops.get(i, 0) + (v[2] - p[2])
+   hot = []
+   for l in ( b, ops ):
+      top = [ (n, i) for i, n in l.iteritems() if n > 0 ]
+      top.sort()
+      for n, i in top[-k:]:
+         if i not in hot:
+            hot.append(i)
+   return hot
+
+def diffStats(old, new):
+   # find what has changed between two sets of gathered stats.
+   # ost/mdt's that have gone away are marked with None
+   d = {}
+   for f in new.keys():
+      oldf = old.get(f, {})
+      d[f] = {}
+      for ost, n in new[f].iteritems():
+         if ost not in oldf.keys():
+            d[f][ost] = { 'chg':n, 'del':[] }
+            continue
+         prev = oldf[ost]
+         if n == prev:
+            continue
+         chg = {}
+         for i, v in n.iteritems():
+            if prev.get(i) != v:
+               chg[i] = v
+         dels = []
+         for i in prev.keys():
+            if i not in n:
+               dels.append(i)
+         d[f][ost] = { 'chg':chg, 'del':dels }
+      for ost in oldf.keys():
+         if ost not in new[f].keys():
+            d[f][ost] = None
+   return d
+
+def applyDelta(state, d):
+   # rebuild full stats from the previous state and a delta from diffStats
+   for f in d.keys():
+      if f not in state.keys():
+         state[f] = {}
+      for ost, dd in d[f].iteritems():
+         if dd == None:
+            if ost in state[f].keys():
+               del state[f][ost]
+            continue
+         if ost not in state[f].keys():
+            state[f][ost] = {}
+         state[f][ost].update(dd['chg'])
+         for i in dd['del']:
+            if i in state[f][ost]:
+               del state[f][ost][i]
+   return state
 
 def uniq( list ):
    l = []
@@ -226,7 +527,65 @@ def uniq( list ):
       prev = i
    return l
 
-def sumDataToClients(o, t):
+def readScale(d, prev, tSweep, tOld):
+   # staggered clients say when each ost/mdt was read. scale its increments
+   # from the time between reads to the time between sweeps
+   if 'time' in prev and 'time' in d:
+      tRead = d['time'] - prev['time']
+      if tRead > 0:
+         return (tSweep - tOld)/tRead
+   return 1
+
+def addOps(opSums, opSumsOld, f, i, v, p, scale):
+   # add the increments in a client's per-op counts on to its sums, which
+   # start from the previous sums the first time the client is seen
+   if f not in opSums.keys():
+      opSums[f] = [ {} for n in mdsOpNames ]
+   sums = opSums[f]
+   if i not in sums[0]:
+      old = opSumsOld.get(f)
+      for k in range(len(mdsOpNames)):
+         if old == None:
+            sums[k][i] = 0
+         else:
+            sums[k][i] = old[k].get(i, 0)
+   for k in range(len(mdsOpNames)):
+      d = v[k] - p[k]
+      if d > 0:
+         sums[k][i] += scale*d
+
+def outputOps(g, f, opsOld, ops, tOld, t):
+   # per-op rates for each client. only the mdsOpTop busiest ops of each
+   # client are sent to ganglia
+   rates = []
+   for k in range(len(mdsOpNames)):
+      rate, err = computeRates( opsOld[k], ops[k], tOld, t )
+      rates.append(rate)
+   top = [ {} for n in mdsOpNames ]
+   for i in rates[0].keys():
+      l = [ ( rates[k][i], k ) for k in range(len(mdsOpNames)) if rates[k][i] > 0 ]
+      l.sort()
+      for rate, k in l[-mdsOpTop:]:
+         top[k][i] = rate
+   fsGangliaName = nameMap[f]
+   for k in range(len(mdsOpNames)):
+      spoofIntoGanglia(g, top[k], fsGangliaName + '_mds_' + mdsOpNames[k] + '_ops', 'ops/sec')
+
+def addLoad(l, lOld, k, v):
+   # add increments v on to the sums for k, starting from the previous sums
+   if k not in l:
+      l[k] = lOld.get(k, ( 0, 0, 0 ))
+   r, w, ops = l[k]
+   l[k] = ( r + v[0], w + v[1], ops + v[2] )
+
+def sumDataToClients(o, t, tSweep, st, load = None, opSums = None):
+   # the counters from each ost/mdt of each oss/mds are compared with the
+   # baseline for that ost/mdt from the previous sweep, and the increments
+   # are added on to the previous sums for each client. the sums only ever go
+   # up, so a rebooted or reconnecting oss/mds or a re-mounted client only
+   # blanks its own contribution for one sweep, rather than resetting all rates.
+   # optionally also fill load with per-ost/mdt and per-oss/mds sums, and
+   # opSums with a list of per-client sums for each of mdsOpNames
    # check times across stats are recent
    tData = t
    for oss in o.keys():
@@ -249,7 +608,9 @@ def sumDataToClients(o, t):
          if len(o[oss]['data'].keys()):
             fss.extend(o[oss]['data'].keys())
             for f in o[oss]['data'].keys():  # filesystems
-               Nost += len(o[oss]['data'][f].keys())
+               for ost in o[oss]['data'][f].keys():
+                  if o[oss]['data'][f][ost]['type'] in ( 'oss', 'mds' ):
+                     Nost += o[oss]['data'][f][ost].get('count', 1)
          else:
             print >>sys.stderr, 'no filesystems found on', oss
       else:
@@ -265,21 +626,26 @@ def sumDataToClients(o, t):
          continue
       for f in o[oss]['data'].keys():  # filesystems
          for ost in o[oss]['data'][f].keys():
-            c.extend(o[oss]['data'][f][ost].keys())
+            if o[oss]['data'][f][ost]['type'] in ( 'oss', 'mds' ):  # skip per-ost totals
+               c.extend(o[oss]['data'][f][ost].keys())
    c.sort()
    c = uniq(c)
-   if 'type' in c:
-      c.remove('type')
+   for i in targetMeta:
+      if i in c:
+         c.remove(i)
    if verbose:
       #print 'clients', len(c)
       print 'oss/mds', len(o.keys()), 'ost/mdt', Nost, 'clients', len(c), 'filesystems', fss
       #print 'client list', time.time() - t
 
-   # make zero'd client lists
+   # client lists start from the previous sums
+   rOld, wOld, ossOpsOld, mdsOpsOld, rCntOld, wCntOld, fssOld = st['d']
    r = {}
    w = {}
    ossOps = {}
    mdsOps = {}
+   rCnt = {}
+   wCnt = {}
    ostCnt = {}
    mdtCnt = {}
    for f in fss:
@@ -287,13 +653,23 @@ def sumDataToClients(o, t):
       w[f] = {}
       ossOps[f] = {}
       mdsOps[f] = {}
+      rCnt[f] = {}
+      wCnt[f] = {}
       ostCnt[f] = 0
       mdtCnt[f] = 0
+      rf = rOld.get(f, {})
+      wf = wOld.get(f, {})
+      ossOpsf = ossOpsOld.get(f, {})
+      mdsOpsf = mdsOpsOld.get(f, {})
+      rCntf = rCntOld.get(f, {})
+      wCntf = wCntOld.get(f, {})
       for i in c:
-         r[f][i] = 0
-         w[f][i] = 0
-         ossOps[f][i] = 0
-         mdsOps[f][i] = 0
+         r[f][i] = rf.get(i, 0)
+         w[f][i] = wf.get(i, 0)
+         ossOps[f][i] = ossOpsf.get(i, 0)
+         mdsOps[f][i] = mdsOpsf.get(i, 0)
+         rCnt[f][i] = rCntf.get(i, 0)
+         wCnt[f][i] = wCntf.get(i, 0)
 
    # debug
    rTot, wTot, ossOpsTot, mdsOpsTot = {},{},{},{}
@@ -303,41 +679,105 @@ def sumDataToClients(o, t):
       ossOpsTot[f] = 0
       mdsOpsTot[f] = 0
 
-   # sum across clients
+   if load != None:
+      for f in fss:
+         load[f] = { 'ost':{}, 'oss':{}, 'host':{}, 'type':{} }
+
+   # only baselines from the previous sweep are used. older ones would put
+   # more than one sweep's worth of i/o into this sweep
+   base = {}
+   for k, v in st['base'].iteritems():
+      if v[0] == st['tOld']:
+         base[k] = v[1]
+   newBase = {}
+
+   # sum increments across clients
    for oss in o.keys():
       if o[oss]['dataType'] == 'relay':  # skip relay data
          continue
+      ip = oss[0]
       s = o[oss]['data'] # shorten for easier use
       for f in s.keys(): # filesystems
+         if load != None:
+            loadOld = st['load'].get(f, { 'ost':{}, 'oss':{} })
          for ost in s[f].keys():
+            # leave 'type' in place. data may be persistent delta state
+            # pre-summed data from a client counts as all the osts that went into it
             machType = s[f][ost]['type']  # oss or mds
-            del s[f][ost]['type']
+            if machType not in ( 'oss', 'mds', 'detail' ):
+               continue
+            k = ( ip, f, ost )
+            newBase[k] = ( tSweep, dict(s[f][ost]) )
+            prev = base.get(k, {})
+            scale = readScale(s[f][ost], prev, tSweep, st['tOld'])
             if machType == 'oss':
-               ostCnt[f] += 1
-               for i in s[f][ost].keys():  # loop over clients
-                  rc, wc, opsc = s[f][ost][i]
-                  r[f][i] += rc
-                  w[f][i] += wc
-                  ossOps[f][i] += opsc
-                  if verbose:  # info/debug
-                     rTot[f] += rc
-                     wTot[f] += wc
-                     ossOpsTot[f] += opsc
+               ostCnt[f] += s[f][ost].get('count', 1)
+               ops = ossOps[f]
+               opsTot = ossOpsTot
+            elif machType == 'mds':
+               mdtCnt[f] += s[f][ost].get('count', 1)
+               ops = mdsOps[f]
+               opsTot = mdsOpsTot
+            elif machType == 'detail' and load != None:
+               # per-ost totals sent by a pre-summing client
+               for i, v in s[f][ost].iteritems():
+                  if i in targetMeta:
+                     continue
+                  load[f]['host'][i] = ip
+                  if '-MDT' in i:
+                     load[f]['type'][i] = 'mds'
+                  else:
+                     load[f]['type'][i] = 'oss'
+                  p = prev.get(i)
+                  if p == None or v[0] < p[0] or v[1] < p[1] or v[2] < p[2]:
+                     v = p = ( 0, 0, 0 )
+                  addLoad(load[f]['ost'], loadOld['ost'], i, ( scale*(v[0] - p[0]), scale*(v[1] - p[1]), scale*(v[2] - p[2]) ))
+               continue
             else:
-               mdtCnt[f] += 1
-               for i in s[f][ost].keys():  # loop over clients
-                  rc, wc, opsc = s[f][ost][i]
-                  r[f][i] += rc
-                  w[f][i] += wc
-                  mdsOps[f][i] += opsc
-                  if verbose:  # info/debug
-                     rTot[f] += rc
-                     wTot[f] += wc
-                     mdsOpsTot[f] += opsc
+               continue
+
+            rt, wt, opst = 0, 0, 0
+            for i, v in s[f][ost].iteritems():  # loop over clients
+               if i in targetMeta or i not in prev:  # new clients only set a baseline
+                  continue
+               p = prev[i]
+               rc = v[0] - p[0]
+               wc = v[1] - p[1]
+               opsc = v[2] - p[2]
+               if rc < 0 or wc < 0 or opsc < 0:
+                  # counters went backwards. the client re-connected or the ost restarted
+                  continue
+               rc *= scale
+               wc *= scale
+               opsc *= scale
+               r[f][i] += rc
+               w[f][i] += wc
+               ops[i] += opsc
+               # read and write rpc counts. not sent by older clients
+               if len(v) > 3 and len(p) > 3 and v[3] >= p[3] and v[4] >= p[4]:
+                  rCnt[f][i] += scale*(v[3] - p[3])
+                  wCnt[f][i] += scale*(v[4] - p[4])
+               # per-op mds counts
+               if len(v) > 5 and len(p) > 5 and opSums != None:
+                  addOps(opSums, st['ops'], f, i, v[5], p[5], scale)
+               rt += rc
+               wt += wc
+               opst += opsc
+            if verbose:  # info/debug
+               rTot[f] += rt
+               wTot[f] += wt
+               opsTot[f] += opst
+            if load != None:
+               if 'count' not in s[f][ost].keys():  # a real ost/mdt, not pre-summed
+                  addLoad(load[f]['ost'], loadOld['ost'], ost, ( rt, wt, opst ))
+                  load[f]['host'][ost] = ip
+                  load[f]['type'][ost] = machType
+               addLoad(load[f]['oss'], loadOld['oss'], ip, ( rt, wt, opst ))
+   st['base'] = newBase
    if verbose:
       #print 'c', c
       for f in fss:
-         print f, 'tot GB r,w, M ops mds,oss', rTot[f]/(1024*1024*1024), wTot[f]/(1024*1024*1024), mdsOpsTot[f]/(1024*1024), ossOpsTot[f]/(1024*1024)
+         print f, 'sweep GB r,w, M ops mds,oss', rTot[f]/(1024*1024*1024), wTot[f]/(1024*1024*1024), mdsOpsTot[f]/(1024*1024), ossOpsTot[f]/(1024*1024)
       print 'client process time', time.time() - t
 
    # we are only monitoring the mdt for some fs's and in those cases don't
@@ -348,8 +788,411 @@ def sumDataToClients(o, t):
          r[f] = {}
          w[f] = {}
          ossOps[f] = {}
+         rCnt[f] = {}
+         wCnt[f] = {}
+
+   return r, w, ossOps, mdsOps, rCnt, wCnt, fss
+
+def hotRates(o, m, t):
+   # per-client rates from a hot message from one oss/mds. each ost/mdt entry
+   # is compared with the previous hot sample of the same entry
+   if 'hot' not in o.keys():
+      o['hot'] = {}
+   base = o['hot']
+   rates = {}
+   for f in m.keys():
+      if f not in base.keys():
+         base[f] = {}
+      rates[f] = ( {}, {}, {}, {} )
+      r, w, ossOps, mdsOps = rates[f]
+      for ost, d in m[f].iteritems():
+         machType = d['type']
+         if machType == 'oss':
+            ops = ossOps
+         elif machType == 'mds':
+            ops = mdsOps
+         else:
+            continue
+         prev = base[f].get(ost, {})
+         b = {}
+         for i, v in d.iteritems():
+            if i in targetMeta:
+               continue
+            b[i] = ( t, v )
+            if i not in prev:
+               continue
+            tOld, p = prev[i]
+            deltat = t - tOld
+            if deltat <= 0 or deltat > dt:  # ignore samples from an earlier hot set
+               continue
+            r[i] = r.get(i, 0.0) + max(0, v[0] - p[0])/deltat
+            w[i] = w.get(i, 0.0) + max(0, v[1] - p[1])/deltat
+            ops[i] = ops.get(i, 0.0) + max(0, v[2] - p[2])/deltat
+         base[f][ost] = b
+   o['hotRate'] = rates
+
+def spoofHot(g, o):
+   # add up the hot rates from all oss/mds's and send them to ganglia
+   tot = {}
+   for oss in o.keys():
+      if 'hotRate' not in o[oss].keys():
+         continue
+      for f, rates in o[oss]['hotRate'].iteritems():
+         if f not in tot.keys():
+            tot[f] = ( {}, {}, {}, {} )
+         for j in range(4):
+            for i, v in rates[j].iteritems():
+               tot[f][j][i] = tot[f][j].get(i, 0.0) + v
+      del o[oss]['hotRate']
+   for f, ( r, w, ossOps, mdsOps ) in tot.iteritems():
+      if verbose:
+         print 'fs', f, 'hot clients oss', len(r), 'mds', len(mdsOps)
+      fsGangliaName = nameMap[f]
+      spoofIntoGanglia(g,      r, fsGangliaName + '_hot_read_bytes',  'bytes/sec')
+      spoofIntoGanglia(g,      w, fsGangliaName + '_hot_write_bytes', 'bytes/sec')
+      spoofIntoGanglia(g, ossOps, fsGangliaName + '_hot_oss_ops',     'ops/sec')
+      spoofIntoGanglia(g, mdsOps, fsGangliaName + '_hot_mds_ops',     'ops/sec')
+
+def loadRates(loadOld, load, tOld, t):
+   # read, write and ops rates for each ost/mdt and each oss/mds
+   rates = {}
+   for f in load.keys():
+      if f not in loadOld.keys():
+         continue
+      rates[f] = {}
+      for k in ( 'ost', 'oss' ):
+         old = loadOld[f][k]
+         new = load[f][k]
+         rr = []
+         for j in range(3):
+            sOld = {}
+            for i, v in old.iteritems():
+               sOld[i] = v[j]
+            s = {}
+            for i, v in new.iteritems():
+               s[i] = v[j]
+            rate, err = computeRates( sOld, s, tOld, t, 1 )
+            rr.append(rate)
+         rates[f][k] = rr
+   return rates
+
+def findImbalance(rates, types):
+   # max/mean across the osts of a fs for read, write and ops. None if there
+   # are no osts, eg. only mdts, or clients using --presum without --ostdetail
+   imb = []
+   for rate in rates:
+      v = [ rate[i] for i in rate.keys() if types[i] == 'oss' ]
+      if len(v) == 0:
+         return None
+      if sum(v) == 0:
+         imb.append(1.0)
+         continue
+      imb.append(max(v)/(sum(v)/len(v)))
+   return imb
+
+def busiestTargets(rates, n):
+   # index of the n busiest osts/mdts by bytes and by ops
+   r, w, ops = rates
+   b = [ (r[i] + w[i], i) for i in r.keys() ]
+   b.sort()
+   b.reverse()
+   o = [ (ops[i], i) for i in ops.keys() ]
+   o.sort()
+   o.reverse()
+   return b[:n], o[:n]
+
+def outputLoad(g, f, rates, load):
+   # per-ost/mdt and per-oss/mds rates are spoofed into the ganglia of the
+   # servers themselves. imbalance and the busiest targets go to this machine.
+   # returns the busiest targets
+   fsGangliaName = nameMap[f]
+   r, w, ops = rates['oss']
+   spoofIntoGanglia(g,   r, fsGangliaName + '_server_read_bytes',  'bytes/sec')
+   spoofIntoGanglia(g,   w, fsGangliaName + '_server_write_bytes', 'bytes/sec')
+   spoofIntoGanglia(g, ops, fsGangliaName + '_server_ops',         'ops/sec')
+
+   r, w, ops = rates['ost']
+   for i in r.keys():
+      n = fsGangliaName + '_' + i[len(f)+1:]   # eg. vu_short_OST0013
+      ip = load['host'][i]
+      spoofIntoGanglia(g,   { ip:r[i] }, n + '_read_bytes',  'bytes/sec')
+      spoofIntoGanglia(g,   { ip:w[i] }, n + '_write_bytes', 'bytes/sec')
+      spoofIntoGanglia(g, { ip:ops[i] }, n + '_ops',         'ops/sec')
+
+   imb = findImbalance(rates['ost'], load['type'])
+   b, o = busiestTargets(rates['ost'], loadTop)
+   if verbose:
+      print 'fs', f, 'ost imbalance r,w,ops', imb
+      print 'busiest by bytes', b
+      print 'busiest by ops', o
+   # without per-ost data there is nothing to say, and a balanced 1.0 would mislead
+   if dryrun or not len(r):
+      return b, o
+   tmax = gangliaTmax()
+   if imb != None:
+      g.send( fsGangliaName + '_ost_read_imbalance',  '%.2f' % imb[0], 'float', 'max/mean', 'both', tmax, 0, "", "" )
+      g.send( fsGangliaName + '_ost_write_imbalance', '%.2f' % imb[1], 'float', 'max/mean', 'both', tmax, 0, "", "" )
+      g.send( fsGangliaName + '_ost_ops_imbalance',   '%.2f' % imb[2], 'float', 'max/mean', 'both', tmax, 0, "", "" )
+   g.send( fsGangliaName + '_busiest_bytes', ' '.join([ i[len(f)+1:] for rate, i in b if rate > 0 ]), 'string', '', 'both', tmax, 0, "", "" )
+   g.send( fsGangliaName + '_busiest_ops',   ' '.join([ i[len(f)+1:] for rate, i in o if rate > 0 ]), 'string', '', 'both', tmax, 0, "", "" )
+   return b, o
+
+def sumDataToJobs(o, tSweep, st):
+   # like sumDataToClients, the job_stats counters from each ost/mdt of each
+   # oss/mds are compared with the baseline from the previous sweep and the
+   # increments are added on to the previous sums for each job. so an oss/mds
+   # that misses a sweep only blanks its own contribution. returns the sums
+   # and the new baselines
+   jrOld, jwOld, jossOpsOld, jmdsOpsOld = st['j']
+   jr = {}
+   jw = {}
+   jossOps = {}
+   jmdsOps = {}
+   newBase = {}
+   for oss in o.keys():
+      if o[oss]['dataType'] == 'relay':
+         continue
+      ip = oss[0]
+      s = o[oss]['data']
+      for f in s.keys():
+         for ost in s[f].keys():
+            machType = s[f][ost]['type']
+            if machType not in ( 'ossjob', 'mdsjob' ):
+               continue
+            if f not in jr.keys():
+               jr[f] = {}
+               jw[f] = {}
+               jossOps[f] = {}
+               jmdsOps[f] = {}
+            if machType == 'ossjob':
+               ops = jossOps[f]
+            else:
+               ops = jmdsOps[f]
+            k = ( ip, f, ost )  # ost is eg. data-OST0000/jobs
+            newBase[k] = ( tSweep, dict(s[f][ost]) )
+            prev = {}
+            if k in st['base'] and st['base'][k][0] == st['tOld']:
+               prev = st['base'][k][1]
+            scale = readScale(s[f][ost], prev, tSweep, st['tOld'])
+            for i, v in s[f][ost].iteritems():
+               if i in targetMeta:
+                  continue
+               if i not in jr[f]:
+                  jr[f][i] = jrOld.get(f, {}).get(i, 0)
+                  jw[f][i] = jwOld.get(f, {}).get(i, 0)
+                  jossOps[f][i] = jossOpsOld.get(f, {}).get(i, 0)
+                  jmdsOps[f][i] = jmdsOpsOld.get(f, {}).get(i, 0)
+               if i not in prev:  # new jobs only set a baseline
+                  continue
+               p = prev[i]
+               if v[0] < p[0] or v[1] < p[1] or v[2] < p[2]:
+                  # the job's entry expired and came back, or the ost restarted
+                  continue
+               jr[f][i] += scale*(v[0] - p[0])
+               jw[f][i] += scale*(v[1] - p[1])
+               ops[i] += scale*(v[2] - p[2])
+   return ( jr, jw, jossOps, jmdsOps ), newBase
+
+def jobMetricName(job):
+   # job ids can have anything in them. keep ganglia metric names sane
+   n = ''
+   for i in job:
+      if i.isalnum() or i in '._-':
+         n += i
+      else:
+         n += '_'
+   return n
+
+def outputJobs(g, f, t, jrRate, jwRate, jossOpsRate, jmdsOpsRate):
+   # ganglia gets the busiest jobs by bytes and by ops as metrics of this machine.
+   # all active jobs go to jobFile
+   if jobFile != None:
+      try:
+         fp = open(jobFile, 'a')
+         for i in jrRate.keys():
+            if jrRate[i] or jwRate[i] or jossOpsRate[i] or jmdsOpsRate[i]:
+               fp.write('%d %s %s %.2f %.2f %.2f %.2f\n' % (t, f, i, jrRate[i], jwRate[i], jossOpsRate[i], jmdsOpsRate[i]))
+         fp.close()
+      except:
+         print >>sys.stderr, 'problem writing job rates to', jobFile
 
-   return r, w, ossOps, mdsOps, fss
+   outputTopJobs(g, f, 'job', jrRate, jwRate, jossOpsRate, jmdsOpsRate)
+
+def outputTopJobs(g, f, kind, jrRate, jwRate, jossOpsRate, jmdsOpsRate):
+   # send the jobTop busiest jobs by bytes and by ops to ganglia, named eg. <fs>_<kind>_<job>_read_bytes
+   if dryrun:
+      return
+   b = []
+   ops = []
+   for i in jrRate.keys():
+      b.append((jrRate[i] + jwRate[i], i))
+      ops.append((jossOpsRate[i] + jmdsOpsRate[i], i))
+   b.sort()
+   ops.sort()
+   top = []
+   for l in ( b, ops ):
+      for rate, i in l[-jobTop:]:
+         if rate > 0 and i not in top:
+            top.append(i)
+
+   fsGangliaName = nameMap[f]
+   tmax = gangliaTmax()
+   for i in top:
+      n = fsGangliaName + '_' + kind + '_' + jobMetricName(i)
+      g.send( n + '_read_bytes',  '%.2f' % jrRate[i],       'float', 'bytes/sec', 'both', tmax, 0, "", "" )
+      g.send( n + '_write_bytes', '%.2f' % jwRate[i],       'float', 'bytes/sec', 'both', tmax, 0, "", "" )
+      g.send( n + '_oss_ops',     '%.2f' % jossOpsRate[i], 'float', 'ops/sec',   'both', tmax, 0, "", "" )
+      g.send( n + '_mds_ops',     '%.2f' % jmdsOpsRate[i], 'float', 'ops/sec',   'both', tmax, 0, "", "" )
+
+def meanSize(b, n):
+   # mean bytes per rpc of each client from byte and rpc rates. 0 if idle
+   m = {}
+   for i, v in n.iteritems():
+      if v > 0:
+         m[i] = b.get(i, 0.0)/v
+      else:
+         m[i] = 0.0
+   return m
+
+def decayHitters(h, deltat):
+   # the counts in each window decay exponentially with its time constant
+   for ( f, m, w ), s in h.iteritems():
+      decay = math.exp(-deltat/dict(hitterWindows)[w])
+      c = s['c']
+      for i in c.keys():
+         c[i] *= decay
+      s['n'] *= decay
+      s['dec'] *= decay
+
+def updateHitters(h, f, rates, deltat):
+   # add a sweep of client rates to misra-gries summaries for each metric and
+   # window. the summaries must already have been decayed for the sweep.
+   # when there are too many clients the (hitterSize+1)th biggest count is
+   # taken off all of them and only the positive ones are kept. so counts are
+   # low by at most 'dec', which is at most 'n'/(hitterSize+1) where 'n' is
+   # the total over all clients
+   for ( w, tau ) in hitterWindows:
+      for m in range(len(hitterMetrics)):
+         k = ( f, hitterMetrics[m], w )
+         if k not in h.keys():
+            h[k] = { 'c':{}, 'n':0.0, 'dec':0.0 }
+   for ( w, tau ) in hitterWindows:
+      for m in range(len(hitterMetrics)):
+         s = h[( f, hitterMetrics[m], w )]
+         c = s['c']
+         for i, v in rates[m].iteritems():
+            if v > 0:
+               c[i] = c.get(i, 0.0) + v*deltat
+               s['n'] += v*deltat
+         if len(c) > hitterSize:
+            cut = heapq.nlargest(hitterSize + 1, c.itervalues())[-1]
+            s['dec'] += cut
+            s['c'] = dict( [ ( i, v - cut ) for i, v in c.iteritems() if v > cut ] )
+
+def printHitters(fn, fsList):
+   saved = readSnapshot(fn)
+   if saved == None or 'hitters' not in saved.keys():
+      print >>sys.stderr, 'no heavy hitters found in snapshot', fn
+      sys.exit(1)
+   h = saved['hitters']
+   # counts are as of the last sweep in the snapshot
+   print 'heavy hitters as of', time.ctime(saved['tOld'])
+   fss = [ k[0] for k in h.keys() ]
+   fss.sort()
+   fss = uniq(fss)
+   keys = []
+   for f in fss:
+      if len(fsList) and f not in fsList:
+         continue
+      for m in hitterMetrics:
+         for w, tau in hitterWindows:
+            if ( f, m, w ) in h.keys():
+               keys.append(( f, m, w ))
+   for f, m, w in keys:
+      s = h[( f, m, w )]
+      top = [ ( v, i ) for i, v in s['c'].iteritems() ]
+      top.sort()
+      top.reverse()
+      print
+      print '%s %s over the last %s. total %.0f, counts may be low by up to %.0f' % ( nameMap.get(f, f), m, w, s['n'], s['dec'] )
+      for v, i in top[:hitterTop]:
+         host = getHost(i.split('@')[0])
+         if host == None:
+            host = ''
+         print '  %-24s %-24s %.0f' % ( i, host, v )
+
+def nidHost(nid):
+   # short hostname of a lustre client nid, or None
+   try:
+      return nidHosts[nid]
+   except:
+      pass
+   host = getHost(nid.split('@')[0])
+   if host != None:
+      host = host.split('.')[0]
+   nidHosts[nid] = host
+   return host
+
+def loadJobMap():
+   # re-read the node to job map if the file has changed. only the nodes whose
+   # jobs have changed are updated in the job to nodes index
+   try:
+      mtime = os.stat(jobMapFile).st_mtime
+   except:
+      if jobMap['mtime'] != -1:
+         print >>sys.stderr, 'could not find job map', jobMapFile
+         jobMap['mtime'] = -1
+      return
+   if mtime == jobMap['mtime']:
+      return
+   node = {}
+   try:
+      for l in open(jobMapFile, 'r'):
+         l = l.split()
+         if len(l) < 2 or l[0][0] == '#':
+            continue
+         # schedulers may list a job once per slot. each job counts once
+         node[l[0].split('.')[0]] = tuple(sorted(set(l[1:])))
+   except:
+      print >>sys.stderr, 'problem reading job map', jobMapFile
+      return
+   jobMap['mtime'] = mtime
+
+   old = jobMap['node']
+   job = jobMap['job']
+   for n, jobs in old.iteritems():
+      if node.get(n) == jobs:
+         continue
+      for j in jobs:
+         job[j].discard(n)
+         if not len(job[j]):
+            del job[j]
+   for n, jobs in node.iteritems():
+      if old.get(n) == jobs:
+         continue
+      for j in jobs:
+         if j not in job:
+            job[j] = set()
+         job[j].add(n)
+   jobMap['node'] = node
+   if verbose:
+      print 'job map has', len(node), 'nodes', len(job), 'jobs'
+
+def jobMapRates(rates):
+   # roll a tuple of per-client rates up into rates for the jobs on each
+   # client's node. nodes shared between jobs count towards all of them
+   node = jobMap['node']
+   out = []
+   for rate in rates:
+      jr = dict.fromkeys(jobMap['job'], 0.0)
+      for i, v in rate.iteritems():
+         h = nidHost(i)
+         if h not in node:
+            continue
+         for j in node[h]:
+            jr[j] += v
+      out.append(jr)
+   return out
 
 def mergeRemotePreSummed(o, d):
    t = time.time()
@@ -363,12 +1206,15 @@ def mergeRemotePreSummed(o, d):
       return d
 
    # local data
-   r, w, ossOps, mdsOps, fss = d
+   r, w, ossOps, mdsOps, rCnt, wCnt, fss = d
 
    for oss in o.keys():
       if o[oss]['dataType'] != 'relay':  # skip local data
          continue
-      rRem, wRem, ossOpsRem, mdsOpsRem, fssRem = o[oss]['data']['d']
+      if len(o[oss]['data']['d']) != len(d):
+         print >>sys.stderr, 'remote summed data from', oss, 'is from a different version. skipping'
+         continue
+      rRem, wRem, ossOpsRem, mdsOpsRem, rCntRem, wCntRem, fssRem = o[oss]['data']['d']
 
       rTot = 0
       wTot = 0
@@ -385,6 +1231,8 @@ def mergeRemotePreSummed(o, d):
          w[f] = wRem[f]
          ossOps[f] = ossOpsRem[f]
          mdsOps[f] = mdsOpsRem[f]
+         rCnt[f] = rCntRem[f]
+         wCnt[f] = wCntRem[f]
 
          if verbose:
             for c in r[f].keys():
@@ -399,12 +1247,136 @@ def mergeRemotePreSummed(o, d):
    if verbose:
       print 'remote merge process time', time.time() - t
 
-   return r, w, ossOps, mdsOps, fss
+   return r, w, ossOps, mdsOps, rCnt, wCnt, fss
 
 def zeroOss(o):
    o['size'] = -1
    # leave o['data'] intact
 
+def unpackFrame(o, m):
+   # legacy and relay messages carry all their data. delta mode clients send a
+   # keyframe with all their stats and then only changes relative to that.
+   # return 0 if a delta can't be applied and we need a new keyframe
+   frame = m.pop('frame', None)
+   seq = m.pop('seq', None)
+   if frame == None:
+      o['data'] = m
+      return 1
+   if frame == 'key':
+      o['state'] = m
+   else:
+      if 'state' not in o.keys() or seq != o['seq'] + 1:
+         if 'state' in o.keys():
+            del o['state']
+         return 0
+      applyDelta(o['state'], m)
+   o['seq'] = seq
+   # full data stays in 'state' after processing so that the next delta can be applied
+   o['data'] = o['state']
+   return 1
+
+def handleDatagram(o, data, addr):
+   # check a datagram from a udp client and add it to the sweep it belongs to.
+   # returns the dataType of the sweep it was added to, or None
+   if len(data) < 128:
+      print >>sys.stderr, 'short datagram. skipping', addr, 'len', len(data)
+      return None
+   # see constructDatagram for the fields in the header
+   h = data[:128]
+   if h[96:128] != hashlib.md5(h[:96] + secretText).hexdigest():
+      print >>sys.stderr, 'corrupted datagram header from', addr, 'hashes do not match'
+      return None
+   b = data[128:]
+   if hashlib.md5(b).hexdigest() != h[64:96]:
+      print >>sys.stderr, 'corrupted datagram from', addr, 'hash does not match'
+      return None
+   try:
+      sweep, part, nparts = [ int(i) for i in h[:64].split()[1:4] ]
+      m = cPickle.loads(b)
+      dataType = m.pop('dataType')
+   except:
+      print >>sys.stderr, 'corrupted data in datagram from', addr
+      return None
+
+   c = ( addr[0], 'udp' )
+   if c not in o.keys():
+      print >>sys.stderr, 'new udp client', addr[0]
+      o[c] = { 'size':-1, 'dataType':'direct', 'data':{}, 'time':time.time() }
+   u = o[c]
+
+   if 'dt' in m.keys():
+      if m['dt'] != dt and u.get('dt') != m['dt']:
+         print >>sys.stderr, 'client', c, 'gathers every', m['dt'], 'seconds but we expect', dt
+      u['dt'] = m['dt']
+      del m['dt']
+
+   # hot and full sweeps are reassembled separately. sweeps are numbered by
+   # the client's interval so stragglers from old sweeps can be spotted
+   k = 'sweep'
+   if dataType == 'hot':
+      k = 'hotSweep'
+   elif sweep <= u.get('processed', -1):
+      print >>sys.stderr, 'late datagram from', c, 'for sweep', sweep
+      return None
+   r = u.get(k)
+   if r == None or sweep > r['sweep']:
+      r = { 'sweep':sweep, 'parts':set(), 'nparts':nparts, 'data':{} }
+      u[k] = r
+      if dataType != 'hot':
+         u['dataType'] = dataType
+         u['data'] = r['data']
+   elif sweep < r['sweep']:
+      return None
+   if part in r['parts']:
+      return None
+   r['parts'].add(part)
+
+   # a target too big for one datagram is split into several
+   for f, d in m.iteritems():
+      if f not in r['data'].keys():
+         r['data'][f] = {}
+      for ost, v in d.iteritems():
+         if ost in r['data'][f]:
+            r['data'][f][ost].update(v)
+         else:
+            r['data'][f][ost] = v
+
+   if dataType == 'hot':
+      # a partial hot sweep would look like idle clients. only use complete ones
+      if len(r['parts']) < r['nparts']:
+         return None
+      hotRates(u, r['data'], time.time())
+      del u[k]
+      return dataType
+   u['time'] = time.time()
+   return dataType
+
+def udpSweepDone(o, t):
+   # report datagrams lost from the sweep that was just processed, and forget
+   # about udp clients that have stopped sending
+   for c in o.keys():
+      if c[1] != 'udp':
+         continue
+      u = o[c]
+      if 'sweep' in u.keys():
+         r = u['sweep']
+         if len(r['parts']) < r['nparts']:
+            print >>sys.stderr, 'lost', r['nparts'] - len(r['parts']), 'of', r['nparts'], 'datagrams of sweep', r['sweep'], 'from', c[0]
+         u['processed'] = r['sweep']
+         del u['sweep']
+      if t - u['time'] > 3*dt:
+         print >>sys.stderr, 'udp client', c[0], 'has gone quiet. dropping it'
+         del o[c]
+
+def requestKeyframe(s, o):
+   # ask a delta mode client to re-send all its stats
+   if 'state' in o.keys():
+      del o['state']
+   try:
+      s.send('keyframe\n')
+   except:
+      pass
+
 def removeProcessedData(o):
    for oss in o.keys():
       if 'data' in o[oss].keys():
@@ -466,12 +1438,339 @@ def doRelaySend(rs, host, port, d):
 #  - central fs has only remote clients so most info it gathers is useful only for remote clusters.
 #    however one meaningful number is the per oss data that could be dropped into central fs's ganglia
 
+def processSweep(g, o, st, tLast, serverName, port, t = None):
+   # sum all the data from a sweep of the oss/mds's, turn it into rates and
+   # fire them into gmond. st is the server state that is kept between sweeps.
+   # t is the time of processing, which is only passed in when replaying
+   if t == None:
+      t = time.time()
+   rOld, wOld, ossOpsOld, mdsOpsOld, rCntOld, wCntOld, fssOld = st['d']
+   jOld = st['j']
+   loadOld = st['load']
+   tOld = st['tOld']
+
+   if jobMapFile != None:
+      loadJobMap()
+
+   # only sum oss/mds's that have sent a full message. a new connection may
+   # so far have sent nothing, or only hot data
+   ready = {}
+   for c in o.keys():
+      if 'data' in o[c].keys() and 'time' in o[c].keys():
+         ready[c] = o[c]
+
+   # sum all data from all servers to the clients and jobs. jobs first as
+   # sumDataToClients replaces the baselines
+   j, jobBase = sumDataToJobs(ready, tLast, st)
+   load = {}
+   opSums = {}
+   d = sumDataToClients(ready, t, tLast, st, load, opSums)
+   st['base'].update(jobBase)
+
+   # maybe relay some of the summed data to other server instances
+   st['rs'] = doRelaySend(st['rs'], serverName, port, d)
+
+   # maybe merge remote pre-summed data into our local data
+   d = mergeRemotePreSummed(ready, d)
+
+   r, w, ossOps, mdsOps, rCnt, wCnt, fss = d
+
+   # remove data fields to avoid re-processing data from stopped oss's. not necessary??
+   removeProcessedData(o)
+
+   # decay all the heavy hitters once per sweep, even if there are no rates
+   # to add to them this sweep
+   if tOld != None:
+      decayHitters(st['hitters'], tLast - tOld)
+
+   err = 0
+   if not st['first']:
+      if verbose:
+         print 'rate dt', tLast - tOld
+      for f in fss:  # loop over each fs
+         if f not in rOld.keys():  # new fs. rates start next sweep
+            continue
+         if verbose:
+            print 'fs', f
+         t = time.time()
+         rRate, err1 = computeRates( rOld[f], r[f], tOld, tLast )
+         wRate, err2 = computeRates( wOld[f], w[f], tOld, tLast )
+         ossOpsRate, err3 = computeRates( ossOpsOld[f], ossOps[f], tOld, tLast )
+         mdsOpsRate, err4 = computeRates( mdsOpsOld[f], mdsOps[f], tOld, tLast )
+         rCntRate, err5 = computeRates( rCntOld[f], rCnt[f], tOld, tLast )
+         wCntRate, err6 = computeRates( wCntOld[f], wCnt[f], tOld, tLast )
+
+         # local sums only go up, so err indicates a negative rate in relayed
+         # data. likely a restart of the relaying server
+         fsErr = err1 or err2 or err3 or err4 or err5 or err6
+         err = err or fsErr
+
+         tRate = time.time() - t
+         t = time.time()
+         if verbose:
+            #print 'rRate', rRate
+            #print 'wRate', wRate
+            #print 'ossOpsRate', ossOpsRate
+            #print 'mdsOpsRate', mdsOpsRate
+            printRate('rRate', rRate)
+            printRate('wRate', wRate)
+            printRate('ossOpsRate', ossOpsRate)
+            printRate('mdsOpsRate', mdsOpsRate)
+
+         if not fsErr:
+            fsGangliaName = nameMap[f]
+            spoofIntoGanglia(g,      rRate, fsGangliaName + '_read_bytes',  'bytes/sec')
+            spoofIntoGanglia(g,      wRate, fsGangliaName + '_write_bytes', 'bytes/sec')
+            spoofIntoGanglia(g, ossOpsRate, fsGangliaName + '_oss_ops',     'ops/sec')
+            spoofIntoGanglia(g, mdsOpsRate, fsGangliaName + '_mds_ops',     'ops/sec')
+            spoofIntoGanglia(g,   rCntRate, fsGangliaName + '_read_rpcs',   'rpcs/sec')
+            spoofIntoGanglia(g,   wCntRate, fsGangliaName + '_write_rpcs',  'rpcs/sec')
+            spoofIntoGanglia(g, meanSize(rRate, rCntRate), fsGangliaName + '_read_size',  'bytes')
+            spoofIntoGanglia(g, meanSize(wRate, wCntRate), fsGangliaName + '_write_size', 'bytes')
+            if verbose:
+               print 'spoof into ganglia time', time.time() - t
+
+            updateHitters(st['hitters'], f, ( rRate, wRate, ossOpsRate, mdsOpsRate ), tLast - tOld)
+
+            if jobMapFile != None:
+               jr = jobMapRates(( rRate, wRate, ossOpsRate, mdsOpsRate ))
+               if verbose:
+                  print 'fs', f, 'jobs from job map', len(jr[0])
+               outputTopJobs(g, f, 'jobnodes', jr[0], jr[1], jr[2], jr[3])
+
+      # per-op mds rates
+      for f in opSums.keys():
+         if f in st['ops'].keys():
+            outputOps(g, f, st['ops'][f], opSums[f], tOld, tLast)
+
+      # per-ost and per-oss load
+      lr = loadRates(loadOld, load, tOld, tLast)
+      for f in lr.keys():
+         st['busiest'][f] = outputLoad(g, f, lr[f], load[f])
+
+      # job sums only go up, like client sums
+      jr, jw, jossOps, jmdsOps = j
+      jrOld, jwOld, jossOpsOld, jmdsOpsOld = jOld
+      for f in jr.keys():
+         if f not in jrOld.keys():
+            continue
+         jrRate, e = computeRates( jrOld[f], jr[f], tOld, tLast )
+         jwRate, e = computeRates( jwOld[f], jw[f], tOld, tLast )
+         jossOpsRate, e = computeRates( jossOpsOld[f], jossOps[f], tOld, tLast )
+         jmdsOpsRate, e = computeRates( jmdsOpsOld[f], jmdsOps[f], tOld, tLast )
+         if verbose:
+            print 'fs', f, 'jobs', len(jr[f])
+            printRate('job rRate', jrRate)
+            printRate('job wRate', jwRate)
+         outputJobs(g, f, tLast, jrRate, jwRate, jossOpsRate, jmdsOpsRate)
+
+   if verbose:
+      print
+   st['d'] = d
+   st['j'] = j
+   st['load'] = load
+   st['ops'] = opSums
+   st['tOld'] = tLast
+   st['first'] = 0
+   if err:
+      print >>sys.stderr, 'negative rate found. resetting all rates.'
+      st['first'] = 1
+
+def newServerState():
+   return { 'd':( {}, {}, {}, {}, {}, {}, [] ),  # summed r, w, ossOps, mdsOps, rCnt, wCnt for each client, and fss
+            'j':( {}, {}, {}, {} ),      # per-job jr, jw, jossOps, jmdsOps
+            'load':{},     # per-ost/mdt and per-oss/mds sums
+            'busiest':{},  # index of the busiest osts/mdts of each fs
+            'base':{},     # the last counters from each ost/mdt of each oss/mds
+            'tOld':None,   # time of the last sweep
+            'hitters':{},  # top clients over long windows
+            'ops':{},      # summed per-op mds counts for each client
+            'first':1,
+            'rs':{} }      # relay sockets used to send to other clusters
+
+def readSnapshot(fn):
+   # return the server state saved by writeSnapshot, or None
+   try:
+      f = open(fn, 'rb')
+      h = f.read(64)
+      n = int(h[:32].split()[1])
+      b = f.read(n)
+      f.close()
+   except:
+      return None
+   if len(b) != n or hashlib.md5(b).hexdigest() != h[32:64]:
+      print >>sys.stderr, 'snapshot', fn, 'is incomplete or corrupted. ignoring it'
+      return None
+   try:
+      return cPickle.loads(b)
+   except:
+      return None
+
+def openSnapshot(fn):
+   try:
+      fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0600)
+   except:
+      print >>sys.stderr, 'could not open snapshot file', fn
+      return None
+   return { 'fd':fd, 'map':None }
+
+def writeSnapshot(snap, st):
+   # save the server state in a memory mapped file so that a restarted server
+   # can carry on with rates from the next sweep. the header is written last
+   # so that a partly written snapshot is never used
+   saved = {}
+   for k in snapshotKeys:
+      saved[k] = st[k]
+   b = cPickle.dumps(saved, cPickle.HIGHEST_PROTOCOL)
+   n = 64 + len(b)
+   try:
+      if snap['map'] == None or len(snap['map']) < n:
+         if snap['map'] != None:
+            snap['map'].close()
+         size = n + n/4  # room to grow
+         os.ftruncate(snap['fd'], size)
+         snap['map'] = mmap.mmap(snap['fd'], size)
+      m = snap['map']
+      m[64:n] = b
+      h = 'snapshot %d' % len(b)
+      h += ' '*(32-len(h))
+      h += hashlib.md5(b).hexdigest()
+      m[:64] = h
+   except:
+      print >>sys.stderr, 'problem writing snapshot of', n, 'bytes'
+
+def openRecord(fn):
+   try:
+      f = open(fn, 'ab')
+      idx = open(fn + '.idx', 'a')
+   except:
+      print >>sys.stderr, 'could not open record file', fn
+      return None
+   return { 'f':f, 'idx':idx }
+
+def recordSweep(rec, o, t, tLast):
+   # append all the data from a sweep of the oss/mds's to the record file.
+   # the index line is written after the record so it always points to a
+   # whole record
+   sweep = {}
+   for c in o.keys():
+      if 'data' in o[c].keys() and 'time' in o[c].keys():
+         sweep[c] = { 'dataType':o[c]['dataType'], 'time':o[c]['time'], 'data':o[c]['data'] }
+   b = zlib.compress(cPickle.dumps({ 't':t, 'tLast':tLast, 'o':sweep }, cPickle.HIGHEST_PROTOCOL))
+   h = 'sweep %d' % len(b)
+   h += ' '*(32-len(h))
+   h += hashlib.md5(b).hexdigest()
+   try:
+      f = rec['f']
+      f.seek(0, 2)
+      off = f.tell()
+      f.write(h)
+      f.write(b)
+      f.flush()
+      rec['idx'].write('%.3f %d\n' % (t, off))
+      rec['idx'].flush()
+   except:
+      print >>sys.stderr, 'problem recording sweep of', len(b), 'bytes'
+
+def readRecord(f, off):
+   # return the sweep recorded at offset off, or None
+   try:
+      f.seek(off)
+      h = f.read(64)
+      n = int(h[:32].split()[1])
+      b = f.read(n)
+   except:
+      return None
+   if len(b) != n or hashlib.md5(b).hexdigest() != h[32:64]:
+      return None
+   try:
+      return cPickle.loads(zlib.decompress(b))
+   except:
+      return None
+
+class FileSink:
+   # takes the place of gmetric when replaying, writing one metric per line
+   def __init__(self, fn):
+      if fn == '-':
+         self.f = sys.stdout
+      else:
+         self.f = open(fn, 'a')
+
+   def send(self, name, val, type='', units='', slope='both', tmax=60, dmax=0, group='', spoof=''):
+      self.f.write('%s %s %s %s\n' % (name, val, units, spoof))
+
+def openSink(dest):
+   h = dest.split(':')
+   if len(h) == 2 and h[1].isdigit():
+      import gmetric
+      return gmetric.Gmetric( h[0], int(h[1]), 'udp' )
+   return FileSink(dest)
+
+def lookupNids(o):
+   # resolve the hostnames of all the client nids in a recorded sweep, so that
+   # the job map doesn't do it while processing is being timed
+   for c in o.keys():
+      if o[c].get('dataType') == 'relay' or 'data' not in o[c].keys():
+         continue
+      for f, osts in o[c]['data'].iteritems():
+         for ost, s in osts.iteritems():
+            if s['type'] not in ( 'oss', 'mds' ):
+               continue
+            for i in s.keys():
+               if i not in targetMeta:
+                  nidHost(i)
+
+def replayCode(fn):
+   # feed recorded sweeps through the server's processing. the sweeps are
+   # found through the index, so a partly written last record is skipped
+   try:
+      f = open(fn, 'rb')
+      idx = open(fn + '.idx', 'r').readlines()
+   except:
+      print >>sys.stderr, 'could not open record file', fn, 'and its index'
+      sys.exit(1)
+   g = openSink(replaySink)
+
+   st = newServerState()
+   n = 0
+   tProc = 0.0
+   tStart = None
+   for l in idx:
+      try:
+         off = int(l.split()[1])
+      except:
+         continue
+      rec = readRecord(f, off)
+      if rec == None:
+         print >>sys.stderr, 'corrupted record at offset', off, 'in', fn
+         continue
+      # keep the recorded spacing of sweeps unless going fast
+      if tStart == None:
+         tStart = ( time.time(), rec['t'] )
+      elif not replayFast:
+         sl = tStart[0] + rec['t'] - tStart[1] - time.time()
+         if sl > 0:
+            time.sleep(sl)
+      if jobMapFile != None:
+         lookupNids(rec['o'])
+      t0 = time.time()
+      processSweep(g, rec['o'], st, rec['tLast'], None, port, rec['t'])
+      tProc += time.time() - t0
+      n += 1
+   f.close()
+
+   print >>sys.stderr, 'replayed', n, 'sweeps from', fn
+   if n:
+      print >>sys.stderr, 'processing took %.3f seconds, %.2f ms per sweep' % ( tProc, 1000.0*tProc/n )
+
 def serverCode( serverName, port ):
    import gmetric
 
    # Create a TCP/IP socket
    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
    server.setblocking(0)
+   # allow a quick restart to carry on from the snapshot
+   server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
    # Bind the socket to the port
    server_address = (serverName, port)
@@ -483,6 +1782,18 @@ def serverCode( serverName, port ):
 
    # Sockets from which we expect to read
    inputs = [ server ]
+   # the address of each client connection. getpeername fails once it's reset
+   peers = {}
+
+   # udp clients send to the udp port of the same number
+   udpServer = None
+   if udp:
+      udpServer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      udpServer.setblocking(0)
+      # a sweep from all oss/mds's arrives in a burst
+      udpServer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udpRcvBuf)
+      udpServer.bind(server_address)
+      inputs.append(udpServer)
    # Sockets to which we expect to write
    outputs = []
 
@@ -492,105 +1803,61 @@ def serverCode( serverName, port ):
    #g = gmetric.Gmetric( '239.2.11.71', 8659, 'multicast' )
 
    o = {}
-   fss = []
-
-   r = {}
-   w = {}
-   ossOps = {}
-   mdsOps = {}
 
-   rRate = {}
-   wRate = {}
-   ossOpsRate = {}
-   mdsOpsRate = {}
+   # server state kept between sweeps, maybe from a recent snapshot
+   st = newServerState()
+   snap = None
+   if snapshotFile != None:
+      fn = '%s.%d' % ( snapshotFile, port )
+      saved = readSnapshot(fn)
+      if saved != None and len(saved['d']) != len(st['d']):
+         # sums from an older version can't be resumed
+         print >>sys.stderr, 'snapshot', fn, 'is from an older version. not resuming rates'
+      elif saved != None and time.time() - saved['tOld'] < snapshotMaxAge:
+         print >>sys.stderr, 'resuming from snapshot', fn
+         st.update(saved)
+         st['first'] = 0
+      if saved != None and st['first'] and 'hitters' in saved.keys():
+         # too old for rates, but the long term top clients are still useful
+         st['hitters'] = saved['hitters']
+         decayHitters(st['hitters'], time.time() - saved['tOld'])
+      snap = openSnapshot(fn)
+
+   rec = None
+   if recordFile != None:
+      rec = openRecord(recordFile)
 
    tLast = time.time()  # the time we last got a block from clients
+   tHot = tLast         # the time we last got hot data
+   hotPending = 0
    processed = 1
-   first = 1
-   rs = {}  # relay sockets used to send to other clusters
 
    while inputs:
       # Wait for at least one of the sockets to be ready for processing
       #print >>sys.stderr, '\nwaiting for the next event'
-      timeout = 1  # seconds
+      timeout = min(1.0, dt/4)  # seconds
       readable, writable, exceptional = select.select(inputs, outputs, inputs, timeout)
       #readable, writable, exceptional = select.select(inputs, outputs, inputs)
 
-      if not (readable or writable or exceptional):
-         #print >>sys.stderr, '  timed out, do some other work here'
-         # if the interval is long then just wait 5s, otherwise wait dt/2
-         t = time.time()
-         if not processed and t - tLast > min(5.0, dt/2):
-             # process and fire into gmond
-             rOld = r
-             wOld = w
-             ossOpsOld = ossOps
-             mdsOpsOld = mdsOps
-             fssOld = fss
-             # sum all data from all servers to the clients
-             d = sumDataToClients(o, t)
-
-             # maybe relay some of the summed data to other server instances
-             rs = doRelaySend(rs, serverName, port, d)
-
-             # maybe merge remote pre-summed data into our local data
-             d = mergeRemotePreSummed(o, d)
-
-             r, w, ossOps, mdsOps, fss = d
-
-             # remove data fields to avoid re-processing data from stopped oss's. not necessary??
-             removeProcessedData(o)
-
-             if fss != fssOld:
-                first = 1
-
-             err = 0
-             if not first:
-                if verbose:
-                   print 'rate dt', tLast - tOld
-                for f in fss:  # loop over each fs
-                   if verbose:
-                      print 'fs', f
-                   t = time.time()
-                   rRate[f], err1 = computeRates( rOld[f], r[f], tOld, tLast )
-                   wRate[f], err2 = computeRates( wOld[f], w[f], tOld, tLast )
-                   ossOpsRate[f], err3 = computeRates( ossOpsOld[f], ossOps[f], tOld, tLast )
-                   mdsOpsRate[f], err4 = computeRates( mdsOpsOld[f], mdsOps[f], tOld, tLast )
-
-                   # err indicates a negative rate. likely an ost/mdt failover or oss/mds reboot
-                   fsErr = err1 or err2 or err3 or err4
-                   err = err or fsErr
-
-                   tRate = time.time() - t
-                   t = time.time()
-                   if verbose:
-                      #print 'rRate', rRate[f]
-                      #print 'wRate', wRate[f]
-                      #print 'ossOpsRate', ossOpsRate[f]
-                      #print 'mdsOpsRate', mdsOpsRate[f]
-                      printRate('rRate', rRate[f])
-                      printRate('wRate', wRate[f])
-                      printRate('ossOpsRate', ossOpsRate[f])
-                      printRate('mdsOpsRate', mdsOpsRate[f])
-
-                   if not fsErr:
-                      fsGangliaName = nameMap[f]
-                      spoofIntoGanglia(g,      rRate[f], fsGangliaName + '_read_bytes',  'bytes/sec')
-                      spoofIntoGanglia(g,      wRate[f], fsGangliaName + '_write_bytes', 'bytes/sec')
-                      spoofIntoGanglia(g, ossOpsRate[f], fsGangliaName + '_oss_ops',     'ops/sec')
-                      spoofIntoGanglia(g, mdsOpsRate[f], fsGangliaName + '_mds_ops',     'ops/sec')
-                      if verbose:
-                         print 'spoof into ganglia time', time.time() - t
-
-             if verbose:
-                print
-             tOld = tLast
-             first = 0
-             if err:
-                print >>sys.stderr, 'negative rate found. resetting all rates.'
-                first = 1
-             processed = 1
-         continue
+      # check for work to do on every pass, not just when select times out.
+      # with hot clients something may arrive more often than the timeout.
+      # if the interval is long then just wait 5s, otherwise wait dt/2
+      t = time.time()
+      if not processed and t - tLast > min(5.0, dt/2):
+          # process and fire into gmond
+          if rec != None:
+             recordSweep(rec, o, t, tLast)
+          processSweep(g, o, st, tLast, serverName, port)
+          if udp:
+             udpSweepDone(o, t)
+          if snap != None:
+             writeSnapshot(snap, st)
+          processed = 1
+
+      # hot data from all oss/mds's arrives close together. send it after a short wait
+      if hotPending and time.time() - tHot > min(0.5, dt/4):
+          spoofHot(g, o)
+          hotPending = 0
 
       # Handle inputs
       for s in readable:
@@ -600,47 +1867,76 @@ def serverCode( serverName, port ):
             print >>sys.stderr, 'new connection from', client_address
             connection.setblocking(0)
             inputs.append(connection)
+            peers[connection] = client_address
             o[client_address] = {'size':-1}
             #print o.keys()
-            # any new client appearing or old client disappearing will screw up rates
-            first = 1
+         elif s is udpServer:
+            # read all the datagrams that are waiting
+            while 1:
+               try:
+                  data, addr = s.recvfrom(65536)
+               except socket.error:
+                  break
+               dataType = handleDatagram(o, data, addr)
+               if dataType == 'hot':
+                  tHot = time.time()
+                  hotPending = 1
+               elif dataType != None:
+                  tLast = time.time()
+                  processed = 0
          else:
-            data = s.recv(102400)
-            c = s.getpeername()
+            c = peers[s]
+            try:
+               data = s.recv(102400)
+            except socket.error, e:
+               # eg. a client that closed with a keyframe request unread
+               # resets the connection. treat it as closed
+               print >>sys.stderr, 'error reading from', c, e
+               data = ''
             if data:
                # A readable client socket has data
                #print >>sys.stderr, 'received "%s" from %s, size %d' % (data, s.getpeername(), len(data))
                #print >>sys.stderr, 'from %s, size %d' % (s.getpeername(), len(data))
 
                #print 'non-server message', c
-               if o[c]['size'] == -1: # new message
-                  #print 'new msg'
-                  if len(data) < 128:
-                     print >>sys.stderr, 'short header. skipping', c, 'len', len(data)
-                     continue
-                  try:
-                     # see client section for the fields in the data header
-                     hashh = data[96:128]
-                     if hashh != hashlib.md5(data[:96] + secretText).hexdigest():
-                        print >>sys.stderr, 'corrupted header. skipping. hashes do not match', data[:96], hashh
-                        continue
-                     hashb = data[64:96]
-                     n = int(data[:64].strip().split()[1])
-                     #print 'header', data[:96], data[96:128], 'size', n
-                     o[c]['size'] = n
-                     o[c]['hash'] = hashb
-                     o[c]['msg'] = data[128:]
-                     o[c]['cnt'] = len(o[c]['msg'])
-                  except:
-                     print >>sys.stderr, 'thought it was a header, but failed'
-                     pass  # something dodgy, skip
-               else:
-                  # more of an in-fight message
+               # messages can arrive back to back, eg. hot data that queued up
+               # while a sweep was processed. bytes past the end of one
+               # message are the start of the next
+               data = o[c].pop('partial', '') + data
+               while len(data):
+                  if o[c]['size'] == -1: # new message
+                     #print 'new msg'
+                     if len(data) < 128:
+                        # wait for the rest of the header
+                        o[c]['partial'] = data
+                        break
+                     try:
+                        # see client section for the fields in the data header
+                        hashh = data[96:128]
+                        if hashh != hashlib.md5(data[:96] + secretText).hexdigest():
+                           print >>sys.stderr, 'corrupted header. skipping. hashes do not match', data[:96], hashh
+                           break
+                        hashb = data[64:96]
+                        n = int(data[:64].strip().split()[1])
+                        #print 'header', data[:96], data[96:128], 'size', n
+                        o[c]['size'] = n
+                        o[c]['hash'] = hashb
+                        o[c]['msg'] = ''
+                        o[c]['cnt'] = 0
+                     except:
+                        print >>sys.stderr, 'thought it was a header, but failed'
+                        break  # something dodgy, skip
+                     data = data[128:]
+
+                  # the rest of this message, or as much of it as has arrived
                   #print 'more. cnt', o[c]['cnt'], 'max', o[c]['size']
-                  o[c]['msg'] += data
-                  o[c]['cnt'] += len(data)
+                  part = data[:o[c]['size'] - o[c]['cnt']]
+                  data = data[len(part):]
+                  o[c]['msg'] += part
+                  o[c]['cnt'] += len(part)
 
-               if o[c]['cnt'] == o[c]['size']: # all there?
+                  if o[c]['cnt'] < o[c]['size']: # not all there yet
+                     break
                   #print 'all done'
                   #print >>sys.stderr, 'got all from %s, size %d. checking & unpacking' % (s.getpeername(), o[c]['size'])
                   try:
@@ -649,15 +1945,39 @@ def serverCode( serverName, port ):
                      hashb = hashlib.md5(o[c]['msg']).hexdigest()
                      if hashb != o[c]['hash']:
                         print >>sys.stderr, 'message corrupted. hash does not match. resetting'
+                        requestKeyframe(s, o[c])
                         zeroOss(o[c])
                         continue
                      # data is not corrupted. unpack
-                     o[c]['data'] = cPickle.loads(o[c]['msg'])
+                     m = cPickle.loads(o[c]['msg'])
 
                      # shimmy the datatype up from data dict to the oss level
                      # leaving just fs data in the (non-relay) data
-                     o[c]['dataType'] = o[c]['data']['dataType']
-                     del o[c]['data']['dataType']
+                     dataType = m['dataType']
+                     del m['dataType']
+
+                     # the client's gather interval needs to match ours
+                     if 'dt' in m.keys():
+                        if m['dt'] != dt and o[c].get('dt') != m['dt']:
+                           print >>sys.stderr, 'client', c, 'gathers every', m['dt'], 'seconds but we expect', dt
+                        o[c]['dt'] = m['dt']
+                        del m['dt']
+
+                     # hot clients are processed separately and don't affect sweeps
+                     if dataType == 'hot':
+                        hotRates(o[c], m, time.time())
+                        tHot = time.time()
+                        hotPending = 1
+                        zeroOss(o[c])
+                        continue
+                     o[c]['dataType'] = dataType
+
+                     # rebuild full stats for delta mode clients
+                     if not unpackFrame(o[c], m):
+                        print >>sys.stderr, 'delta out of sequence from', c, 'requesting keyframe'
+                        requestKeyframe(s, o[c])
+                        zeroOss(o[c])
+                        continue
 
                      t = time.time()
                      o[c]['time'] = t
@@ -678,37 +1998,36 @@ def serverCode( serverName, port ):
                   # put the message back into recv mode
                   # note that 'data' has not yet been processed so must be left alone
                   zeroOss(o[c])
-               elif o[c]['cnt'] > o[c]['size']:
-                  print >>sys.stderr, 'too much data. resetting', o[c]['cnt'], o[c]['size']
-                  zeroOss(o[c])
-
             else:
                # Interpret empty result as closed connection
-               print >>sys.stderr, 'closing', client_address, 'after reading no data.'
+               print >>sys.stderr, 'closing', c, 'after reading no data.'
                # Stop listening for input on the connection
                inputs.remove(s)
+               del peers[s]
                s.close()
-               # delete all the data from that oss too
+               # delete all the data from that oss too. when it reconnects
+               # only its own contribution is missing for a sweep
                del o[c]
-               # any new client appearing or old client disappearing will screw up rates
-               first = 1
 
       # Handle "exceptional conditions"
       for s in exceptional:
-         print >>sys.stderr, 'handling exceptional condition for', s.getpeername()
+         if s not in peers.keys():  # already closed
+            continue
+         print >>sys.stderr, 'handling exceptional condition for', peers[s]
          # Stop listening for input on the connection
          inputs.remove(s)
+         del o[peers[s]]
+         del peers[s]
          s.close()
-         # any new client appearing or old client disappearing will screw up rates
-         first = 1
-
-def syncToNextInterval( offset = 0 ):
-   # sleep until the next interval
-   t = time.time() % 60
-   t += (60 + offset)   # optional time skew
-   t %= 60
-   i = int(t/dt)    # interval number
-   sl = (i+1)*dt - t
+
+def syncToNextInterval( offset = 0, period = None ):
+   # sleep until the next interval. intervals are counted from the epoch so
+   # clients agree on them for any period, not just divisions of a minute
+   if period == None:
+      period = dt
+   t = time.time() + offset   # optional time skew
+   i = int(t/period)    # interval number
+   sl = (i+1)*period - t
    #print 'now', t, 'sleeping', sl , 'returning', i
    time.sleep(sl)
    return i, t
@@ -716,15 +2035,33 @@ def syncToNextInterval( offset = 0 ):
 def connectSocket(sp):
    c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
    try:
+      # don't wait long for a server that is down
+      c.settimeout(min(5.0, dt/4))
       c.connect(sp)
+      c.settimeout(None)
    except:
       print >>sys.stderr, 'could not connect to', sp
       c = None
    return c
 
+def keyframeRequested(c):
+   # non-blocking check for keyframe requests from the server.
+   # returns -1 if the server has closed the connection
+   req = 0
+   while select.select([c], [], [], 0)[0]:
+      try:
+         data = c.recv(1024)
+      except:
+         return -1
+      if not data:
+         return -1
+      req = 1
+   return req
+
 def constructMessage(s):
    """construct header and body of message"""
-   b = cPickle.dumps(s)
+   # the binary pickle protocol is about half the size for tuples of counters
+   b = cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL)
    hashb = hashlib.md5(b).hexdigest()
 
    # 128 byte header
@@ -748,54 +2085,315 @@ def constructMessage(s):
 
    return h, b
 
-def clientCode( serverName, port, fsList ):
-   while 1:
-      i, now = syncToNextInterval()
-      c = connectSocket( (serverName, port) )
-      if c == None:
-         time.sleep(5)
+def constructDatagram(s, sweep, part, nparts):
+   """construct header and body of one datagram of a sweep"""
+   b = cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL)
+   hashb = hashlib.md5(b).hexdigest()
+
+   # 128 byte header, laid out like the tcp header
+   #
+   #   length
+   #  in bytes    field
+   #  --------   -------
+   #     4       plain text 'udp '
+   #     N       sweep number, datagram number in the sweep, datagrams in the sweep
+   #  64-N-4     padding
+   #    32       hash of datagram body
+   #    32       hash of all prev bytes of this header + contents of the shared secret file
+
+   h = 'udp %d %d %d' % ( sweep, part, nparts )
+   h += ' '*(64-len(h))
+   h += hashb
+   hashh = hashlib.md5(h + secretText).hexdigest()
+   h += hashh
+
+   return h, b
+
+def sendDatagrams(c, sp, s, sweep):
+   # split a sweep up into datagrams of at most udpEntries clients. each
+   # datagram holds part of one ost/mdt along with its meta fields
+   parts = []
+   for f, d in s.iteritems():
+      if f in ( 'dataType', 'dt' ):
+         continue
+      if not len(d):
+         parts.append( { f:{} } )
+      for ost, v in d.iteritems():
+         meta = {}
+         for i in targetMeta:
+            if i in v.keys():
+               meta[i] = v[i]
+         items = [ (i, v[i]) for i in v.keys() if i not in targetMeta ]
+         for j in range(0, max(1, len(items)), udpEntries):
+            p = dict(meta)
+            p.update(items[j:j+udpEntries])
+            parts.append( { f:{ ost:p } } )
+
+   n = 0
+   for j in range(len(parts)):
+      p = parts[j]
+      p['dataType'] = s['dataType']
+      if 'dt' in s.keys():
+         p['dt'] = s['dt']
+      h, b = constructDatagram(p, sweep, j, len(parts))
+      try:
+         c.sendto(h + b, sp)
+      except:
+         print >>sys.stderr, 'udp send of', len(h), len(b), 'failed'
          continue
+      n += len(b)
+   if verbose:
+      print 'sent', s['dataType'], 'sweep', sweep, len(parts), 'datagrams', n
 
-      while 1:
-         t0 = time.time()
-         s = {}
-         s['dataType'] = 'direct'
-         for f in fsList:
-            s[f] = gatherStats(f)
-         ## debug:
-         ##print s
-         #for o in s.keys():
-         #   print o, len(s[o])
+def startConnect(sp):
+   # start a non-blocking connect so that a server that is down doesn't hold
+   # up the gather or the other servers. finishConnects sees when it's done
+   c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   c.setblocking(0)
+   try:
+      e = c.connect_ex(sp)
+   except:
+      e = errno.EHOSTUNREACH
+   if e not in ( 0, errno.EINPROGRESS ):
+      print >>sys.stderr, 'could not connect to', sp, os.strerror(e)
+      c.close()
+      c = None
+   return c
 
-         h, b = constructMessage(s)
+def finishConnects(dests):
+   # check without waiting which connects in progress have finished. ones that
+   # fail, or are still going after an interval, are started again next sweep
+   pend = {}
+   for n in dests:
+      if n['c'] != None and n['connecting']:
+         pend[n['c']] = n
+   if not len(pend):
+      return
+   w = select.select([], pend.keys(), [], 0)[1]
+   for c, n in pend.iteritems():
+      if c in w:
+         e = c.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+         if e:
+            print >>sys.stderr, 'could not connect to', n['sp'], os.strerror(e)
+            closeDest(n)
+         n['connecting'] = 0
+      elif time.time() - n['tConnect'] > dt:
+         print >>sys.stderr, 'connect to', n['sp'], 'timed out'
+         closeDest(n)
+         n['connecting'] = 0
+
+def connectDest(n):
+   # (re)connect to a destination. delta mode starts again with a keyframe.
+   # tcp destinations can't be sent to until finishConnects says they're up
+   if udp:
+      n['c'] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      n['connecting'] = 0
+   else:
+      n['c'] = startConnect(n['sp'])
+      n['connecting'] = ( n['c'] != None )
+      n['tConnect'] = time.time()
+   n['seq'] = 0
+   n['prev'] = {}
+
+def closeDest(n):
+   try:
+      n['c'].close()
+   except:
+      pass
+   n['c'] = None
+
+def sendParallel(out):
+   # send to all destinations at once, so that a slow or dead one doesn't
+   # hold up the rest. anything not sent within half an interval is dropped
+   # and that destination reconnects next time
+   left = {}
+   for n, b in out:
+      n['c'].setblocking(0)
+      left[n['c']] = [ n, b, 0 ]
+   tEnd = time.time() + dt/2
+   while len(left):
+      w = select.select([], left.keys(), [], max(0, tEnd - time.time()))[1]
+      if not w:
+         break
+      for c in w:
+         n, b, off = left[c]
          try:
-            c.send(h)
-            c.send(b)
-            #print 'sent', len(b)
+            off += c.send(buffer(b, off))
          except:
-            print >>sys.stderr, 'send of', len(h), len(b), 'failed'
-            c.close()
-            break
+            print >>sys.stderr, 'send of', len(b), 'to', n['sp'], 'failed'
+            closeDest(n)
+            del left[c]
+            continue
+         if off == len(b):
+            del left[c]
+         else:
+            left[c][2] = off
+   for n, b, off in left.values():
+      print >>sys.stderr, 'send to', n['sp'], 'timed out after', off, 'of', len(b)
+      closeDest(n)
+
+def sendToAll(dests, d, dataType, sweep):
+   # send each destination the gathered stats of the fs's it wants. messages
+   # that are the same for several destinations are only encoded once
+   msgs = {}
+   out = []
+   finishConnects(dests)
+   for n in dests:
+      if n['c'] == None or n['connecting']:
+         continue
+      sub = {}
+      for f in n['fs']:
+         sub[f] = d[f]
+      key = ( dataType, ) + tuple(n['fs'])
+      if dataType == 'direct':
+         req = 0
+         if not udp:
+            req = keyframeRequested(n['c'])
+         if req < 0:
+            print >>sys.stderr, 'server', n['sp'], 'closed the connection'
+            closeDest(n)
+            continue
+         s = dict(sub)
+         if deltaMode:
+            # each destination has its own sequence of frames
+            key = None
+            if req or n['seq'] % keyframeEvery == 0:
+               s['frame'] = 'key'
+            else:
+               s = diffStats(n['prev'], sub)
+               s['frame'] = 'delta'
+            s['seq'] = n['seq']
+            n['seq'] += 1
+            n['prev'] = sub
+         s['dt'] = dt
+      else:
+         s = sub
+      s['dataType'] = dataType
 
-         iNew, now = syncToNextInterval()
-         if iNew != (i+1)%clientSend or now - t0 > dt:
-            print >>sys.stderr, 'collect took too long', now-t0, 'last interval', i, 'this interval', iNew
-         i = iNew
+      if udp:
+         sendDatagrams(n['c'], n['sp'], s, sweep)
+         continue
+      if key in msgs.keys():
+         h, b = msgs[key]
+      else:
+         h, b = constructMessage(s)
+         if key != None:
+            msgs[key] = ( h, b )
+      if verbose:
+         print 'sent', dataType, s.get('frame', ''), len(b), 'to', n['sp']
+      out.append(( n, h + b ))
+   sendParallel(out)
+
+def clientCode( dests ):
+   # dests is a list of ( (serverName, port), fsList ). each fs is gathered
+   # once per sweep however many destinations it is sent to.
+   # in hot mode wake up every hotInterval to gather the hot clients, and
+   # gather all clients every dt
+   period = dt
+   if hotClients:
+      period = hotInterval
+   ticks = int(round(dt/period))
+
+   fsList = []
+   conns = []
+   for sp, fss in dests:
+      for f in fss:
+         if f not in fsList:
+            fsList.append(f)
+      conns.append({ 'sp':sp, 'fs':fss, 'c':None, 'connecting':0 })
+
+   full = None  # the last full gather. used to find hot clients
+   hot = []
+   pending = None  # a staggered gather to send at the start of the next interval
+
+   i, now = syncToNextInterval(0, period)
+   while 1:
+      t0 = time.time()
+      # reconnects don't block. they carry on while we gather
+      for n in conns:
+         if n['c'] == None:
+            connectDest(n)
+
+      flushed = 0
+      if pending != None:
+         sendToAll(conns, pending, 'direct', i+1)
+         pending = None
+         flushed = 1
+      if (i+1) % ticks:
+         # a hot only interval. the hot clients are skipped if a staggered
+         # sweep was just sent, as it may still be going and it has all the
+         # hot clients in it anyway
+         if len(hot) and not flushed:
+            s = {}
+            for f in fsList:
+               s[f] = gatherStats(f, hot)
+               if presum:
+                  s[f] = presumStats(s[f])
+            sendToAll(conns, s, 'hot', i+1)
+      else:
+         if stagger:
+            d = gatherStaggered(fsList, t0, staggerBudget*period)
+         else:
+            d = {}
+            for f in fsList:
+               d[f] = gatherStats(f)
+         if presum:
+            for f in fsList:
+               d[f] = presumStats(d[f])
+         ## debug:
+         ##print d
+         #for o in d.keys():
+         #   print o, len(d[o])
+
+         if hotClients:
+            if full != None:
+               hot = findHotClients(full, d, hotClients)
+            full = d
+
+         if stagger:
+            pending = d
+         else:
+            sendToAll(conns, d, 'direct', i+1)
+
+      iNew, now = syncToNextInterval(0, period)
+      if iNew != i+1 or now - t0 > period:
+         print >>sys.stderr, 'collect took too long', now-t0, 'last interval', i, 'this interval', iNew
+      i = iNew
 
 def usage():
-   print sys.argv[0] + '[-v|--verbose] [-d|--dryrun] [--secretfile file] [--port portnum] [--interface name] [server fsName1 [fsName2 ...]]'
+   print sys.argv[0] + '[-v|--verbose] [-d|--dryrun] [--delta] [--udp] [--stagger] [--presum [--ostdetail]] [--mdsops] [--jobstats] [--jobfile file] [--jobmap file] [--interval secs] [--hot K [--hotinterval secs]] [--snapshot file] [--dumphitters [fsName ...]] [--record file] [--replay file [--fast] [--sink dest]] [--secretfile file] [--port portnum] [--interface name] [--to server[:port] fsName1[,fsName2...] ...] [server fsName1 [fsName2 ...]]'
    print '  server takes no args'
-   print '  client needs a server name and one or more lustre filesystem names'
+   print '  client needs a server name and one or more lustre filesystem names, and/or --to options'
    print '  --verbose         - print summary of data sent to servers'
    print '  --dryrun          - do not send results to ganglia'
+   print '  --delta           - client sends only changed counters between full keyframes'
+   print '  --udp             - client sends each sweep as datagrams. server also listens for them'
+   print '  --stagger         - client spreads its reads of osts/mdts over part of the interval'
+   print '  --presum          - client sums its osts/mdts for each lustre client before sending'
+   print '  --ostdetail       - with --presum, also send totals for each ost/mdt'
+   print '  --mdsops          - client also sends counts of each metadata op for each client of each mdt'
+   print '  --jobstats        - client also sends per-job counters from lustre job_stats'
+   print '  --jobfile file    - server appends per-job rates to this file. default', jobFile
+   print '  --jobmap file     - server adds up client rates for each job using a file of "hostname jobid ..." lines'
+   print '  --interval secs   - seconds between gathers. must be the same on clients and server. default', dt
+   print '  --hot K           - client also gathers the K busiest clients every hot interval'
+   print '  --hotinterval secs - seconds between gathers of the hot clients. default', hotInterval
+   print '  --snapshot file   - server state is saved in file.<port>, or "none". default', snapshotFile
+   print '  --dumphitters     - print the clients that did the most i/o over the last hour/day/week from the server snapshot'
+   print '  --record file     - server appends the data of every sweep to file, and an index to file.idx'
+   print '  --replay file     - run the sweeps recorded in file through the server processing and exit'
+   print '  --fast            - replay as fast as possible rather than at the recorded pace'
+   print '  --sink dest       - replayed metrics go to a gmond udp host:port or to a file. default', replaySink, '(stdout)'
    print '  --secretfile file - specify an alternate shared secret file. default', secretFile
    print '  --port portnum    - tcp port num to send/recv on. default', port
+   print '  --to server[:port] fsName1[,fsName2...] - client also sends these filesystems to this server.'
+   print '                      can be given more than once. each filesystem is only gathered once'
    print '  --interface name  - make server listen on the interface that matches a hostname of "name".'
    print '                      default is to bind to the interface that matches gethostbyname'
    sys.exit(1)
 
 def parseArgs( host ):
-   global verbose, dryrun, secretFile, port, serverInterfaceName
+   global verbose, dryrun, deltaMode, udp, stagger, presum, ostDetail, opDetail, jobStats, jobFile, jobMapFile, dt, hotClients, hotInterval, snapshotFile, dumpHitters, recordFile, replayFile, replayFast, replaySink, secretFile, port, serverInterfaceName
 
    # parse optional args
    for v in ('-v', '--verbose'):
@@ -806,6 +2404,91 @@ def parseArgs( host ):
       if v in sys.argv:
          dryrun = 1
          sys.argv.remove(v)
+   if '--delta' in sys.argv:
+      deltaMode = 1
+      sys.argv.remove('--delta')
+   if '--udp' in sys.argv:
+      udp = 1
+      sys.argv.remove('--udp')
+   if '--stagger' in sys.argv:
+      stagger = 1
+      sys.argv.remove('--stagger')
+   if '--presum' in sys.argv:
+      presum = 1
+      sys.argv.remove('--presum')
+   if '--ostdetail' in sys.argv:
+      ostDetail = 1
+      sys.argv.remove('--ostdetail')
+   if '--mdsops' in sys.argv:
+      opDetail = 1
+      sys.argv.remove('--mdsops')
+   if '--jobstats' in sys.argv:
+      jobStats = 1
+      sys.argv.remove('--jobstats')
+   if '--jobfile' in sys.argv:
+      v = sys.argv.index( '--jobfile' )
+      assert( len(sys.argv) > v+1 )
+      jobFile = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+   if '--jobmap' in sys.argv:
+      v = sys.argv.index( '--jobmap' )
+      assert( len(sys.argv) > v+1 )
+      jobMapFile = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+   if '--snapshot' in sys.argv:
+      v = sys.argv.index( '--snapshot' )
+      assert( len(sys.argv) > v+1 )
+      snapshotFile = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+      if snapshotFile == 'none':
+         snapshotFile = None
+   if '--dumphitters' in sys.argv:
+      dumpHitters = 1
+      sys.argv.remove('--dumphitters')
+   if '--record' in sys.argv:
+      v = sys.argv.index( '--record' )
+      assert( len(sys.argv) > v+1 )
+      recordFile = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+   if '--replay' in sys.argv:
+      v = sys.argv.index( '--replay' )
+      assert( len(sys.argv) > v+1 )
+      replayFile = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+   if '--fast' in sys.argv:
+      replayFast = 1
+      sys.argv.remove('--fast')
+   if '--sink' in sys.argv:
+      v = sys.argv.index( '--sink' )
+      assert( len(sys.argv) > v+1 )
+      replaySink = sys.argv.pop(v+1)
+      sys.argv.pop(v)
+   if '--interval' in sys.argv:
+      v = sys.argv.index( '--interval' )
+      assert( len(sys.argv) > v+1 )
+      dt = float(sys.argv.pop(v+1))
+      sys.argv.pop(v)
+   if '--hot' in sys.argv:
+      v = sys.argv.index( '--hot' )
+      assert( len(sys.argv) > v+1 )
+      hotClients = int(sys.argv.pop(v+1))
+      sys.argv.pop(v)
+   if '--hotinterval' in sys.argv:
+      v = sys.argv.index( '--hotinterval' )
+      assert( len(sys.argv) > v+1 )
+      hotInterval = float(sys.argv.pop(v+1))
+      sys.argv.pop(v)
+
+   if udp and deltaMode:
+      print 'error: --delta needs the tcp connection to recover from lost messages. it can not be used with --udp'
+      usage()
+   if dt <= 0 or dt > 60:
+      print 'error: --interval must be more than 0 and at most 60 seconds'
+      usage()
+   if hotClients:
+      if hotInterval <= 0 or hotInterval >= dt or abs(dt/hotInterval - round(dt/hotInterval)) > 1e-6:
+         print 'error: --interval', dt, 'must be a multiple of --hotinterval', hotInterval
+         usage()
    if '--secretfile' in sys.argv:
       v = sys.argv.index( '--secretfile' )
       assert( len(sys.argv) > v+1 )
@@ -821,8 +2504,24 @@ def parseArgs( host ):
       assert( len(sys.argv) > v+1 )
       serverInterfaceName = sys.argv.pop(v+1)
       sys.argv.pop(v)
+   while '--to' in sys.argv:
+      v = sys.argv.index( '--to' )
+      assert( len(sys.argv) > v+2 )
+      fss = sys.argv.pop(v+2).split(',')
+      sp = sys.argv.pop(v+1).split(':')
+      sys.argv.pop(v)
+      if len(sp) == 1:
+         sp.append(port)
+      dests.append(( ( sp[0], int(sp[1]) ), fss ))
 
+   if dumpHitters:
+      if snapshotFile == None:
+         print 'error: --dumphitters reads the server snapshot so needs --snapshot file'
+         usage()
+      return host, sys.argv[1:]
    if len(sys.argv) == 1:
+      if len(dests):
+         return None, None # client with only --to destinations
       return host, None # server takes no args
    if len(sys.argv) < 3:
       usage()
@@ -831,6 +2530,12 @@ def parseArgs( host ):
 if __name__ == '__main__':
    host = socket.gethostname()
    serverName, fsList = parseArgs( host )
+   if replayFile != None:
+      replayCode(replayFile)
+      sys.exit(0)
+   if dumpHitters:
+      printHitters('%s.%d' % ( snapshotFile, port ), fsList)
+      sys.exit(0)
    readSecret()
    if host == serverName:
       if serverInterfaceName != None:
@@ -840,4 +2545,6 @@ if __name__ == '__main__':
       if serverInterfaceName != None:
          print 'error: --interface is an option for the server only'
          usage()
-      clientCode( serverName, port, fsList ) # client send code
+      if serverName != None:
+         dests.insert(0, ( ( serverName, port ), fsList ))
+      clientCode( dests ) # client send code